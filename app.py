@@ -1,114 +1,424 @@
+import asyncio
+import atexit
+import hashlib
 import os
-import sys
+import threading
+import time
 import uuid
+from io import BytesIO
 from urllib.parse import quote_plus
 
-# ---------- Python 3.13 cgi compatibility ----------
-if sys.version_info >= (3, 13):
-    import types
-    sys.modules["cgi"] = types.ModuleType("cgi")
-
 # ---------- Disable proxy injection ----------
 for k in ["HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy"]:
     os.environ.pop(k, None)
 
-import requests
-import feedparser
-from flask import Flask, render_template, request, session, jsonify
+import httpx
+import orjson
+import tiktoken
+from lxml import etree
+from cachetools import TTLCache
+from flask import (
+    Flask, Response, render_template, request, session, stream_with_context
+)
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 from openai import OpenAI
 
 # ---------- Flask ----------
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev-secret-key")
 
+# Finished answers are handed to the browser signed, so /save_response only
+# stores text this server generated, for the chat and turn it was asked in,
+# whichever gunicorn worker receives the save.
+answer_signer = URLSafeTimedSerializer(app.secret_key, salt="save-response")
+SAVE_RESPONSE_MAX_AGE = 600
+
 # ---------- OpenAI ----------
 client = OpenAI()
+MODEL = "gpt-4o-mini"
+
+# Prompt budget: each paper is cut on a token boundary, and the whole research
+# block is capped so long PubMed abstracts cannot dominate input latency.
+MAX_TOKENS_PER_PAPER = 256
+MAX_CONTEXT_TOKENS = 3000
+# Rough chars-per-token ratio used when the tiktoken encoding is unavailable
+CHARS_PER_TOKEN = 4
+ENCODING_RETRY_INTERVAL = 60
+
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "You are a medical research assistant.\n"
+        "You MUST use previous conversation context.\n"
+        "You MUST ground answers in scientific research.\n"
+        "If evidence is weak, say so clearly."
+    )
+}
+
+USER_PROMPT_TEMPLATE = "RESEARCH:\n{context}\n\nQUESTION:\n{question}"
 
 # ---------- APIs ----------
-ARXIV_API = "http://export.arxiv.org/api/query"
+ARXIV_API = "https://export.arxiv.org/api/query"
 PUBMED_API = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
 PUBMED_FETCH = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+
+# ---------- NCBI E-utilities ----------
+# NCBI allows 3 req/s per client, or 10 req/s with an API key. The budget is
+# split evenly across gunicorn workers (WEB_CONCURRENCY, see Procfile); each
+# worker may burst up to its share and never queues a call for long.
+NCBI_API_KEY = os.getenv("NCBI_API_KEY")
+CONTACT_EMAIL = os.getenv("CONTACT_EMAIL")
+NCBI_RETRY_AFTER = 1.0
+NCBI_MAX_RETRY_AFTER = 5.0
+NCBI_MAX_QUEUE_DELAY = 2.0
+NCBI_CALLS_PER_QUERY = 2
+
+
+def env_int(name, default):
+    try:
+        return max(1, int(os.getenv(name, default)))
+    except ValueError:
+        return default
+
+
+NCBI_RATE = (10 if NCBI_API_KEY else 3) / env_int("WEB_CONCURRENCY", 4)
+
+
+class RateLimited(Exception):
+    pass
+
+
+class RateLimiter:
+    """Token bucket for coroutines on the shared HTTP event loop."""
+
+    def __init__(self, rate, max_delay):
+        self.rate = rate
+        # Room for at least one esearch + efetch pair, so a lone question never
+        # waits on the limiter even when the per-worker share is below 1 req/s
+        self.capacity = max(rate, float(NCBI_CALLS_PER_QUERY))
+        self.max_delay = max_delay
+        self._tokens = self.capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            if self._updated is not None:
+                elapsed = now - self._updated
+                self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+            # A negative balance means slots already promised to queued calls
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            if delay > self.max_delay:
+                raise RateLimited(f"next NCBI slot is {delay:.1f}s away")
+            self._tokens -= 1
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+PUBMED_LIMIT = RateLimiter(NCBI_RATE, NCBI_MAX_QUEUE_DELAY)
+
+
+def ncbi_params(params):
+    params = {**params, "tool": "healthchat"}
+    if NCBI_API_KEY:
+        params["api_key"] = NCBI_API_KEY
+    if CONTACT_EMAIL:
+        params["email"] = CONTACT_EMAIL
+    return params
+
+
+async def ncbi_get(client, url, params):
+    # On 429 wait out Retry-After once, then let the error propagate so the
+    # caller falls back without caching.
+    for attempt in range(2):
+        await PUBMED_LIMIT.wait()
+        resp = await client.get(url, params=ncbi_params(params))
+        if resp.status_code != 429 or attempt:
+            break
+        retry_after = resp.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else NCBI_RETRY_AFTER
+        await asyncio.sleep(min(delay, NCBI_MAX_RETRY_AFTER))
+    resp.raise_for_status()
+    return resp
+
+# ---------- Shared HTTP client ----------
+# One long-lived event loop owns a pooled HTTP/2 client, so TLS handshakes to
+# arXiv / eutils are paid once per process instead of once per question.
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, daemon=True).start()
+
+
+async def _make_http_client():
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        follow_redirects=True,
+        headers={"User-Agent": "HealthChat/1.0"},
+        limits=httpx.Limits(max_keepalive_connections=20)
+    )
+
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
+HTTP = run_async(_make_http_client())
+
+
+@atexit.register
+def _close_http_client():
+    run_async(HTTP.aclose())
+    _loop.call_soon_threadsafe(_loop.stop)
+
+# ---------- Caches ----------
+# Paper lookups are shared across questions for a day; full answers are reused
+# for an hour when the same question arrives with the same chat history.
+ARXIV_CACHE = TTLCache(maxsize=512, ttl=24 * 3600)
+PUBMED_CACHE = TTLCache(maxsize=512, ttl=24 * 3600)
+ANSWER_CACHE = TTLCache(maxsize=512, ttl=3600)
+_answer_cache_lock = threading.Lock()
+
+
+def normalize_query(query):
+    return hashlib.sha1(query.strip().lower().encode()).hexdigest()
+
+
+def answer_cache_key(chat_messages, question):
+    history = orjson.dumps(chat_messages[-10:], option=orjson.OPT_SORT_KEYS)
+    return normalize_query(question), hashlib.sha1(history).hexdigest()
 
 # =================================================
 #                 PAPER FETCHERS
 # =================================================
 
-def fetch_arxiv_papers(query, max_results=3):
+def parse_arxiv_feed(body):
+    papers = []
+    for _, entry in etree.iterparse(BytesIO(body), tag=f"{ATOM_NS}entry",
+                                    resolve_entities=False, no_network=True):
+        link = entry.find(f"{ATOM_NS}link[@rel='alternate']")
+        papers.append({
+            "title": " ".join((entry.findtext(f"{ATOM_NS}title") or "").split()),
+            "summary": (entry.findtext(f"{ATOM_NS}summary") or "").strip(),
+            "link": link.get("href") if link is not None else entry.findtext(f"{ATOM_NS}id")
+        })
+        entry.clear()
+    return papers
+
+
+async def fetch_arxiv_async(client, query, max_results=3):
+    # Cache is only touched from the HTTP event loop thread, so no lock needed.
+    # Results are stored only after a successful response has been parsed.
+    key = (normalize_query(query), max_results)
+    if key in ARXIV_CACHE:
+        return ARXIV_CACHE[key]
+
     url = f"{ARXIV_API}?search_query=all:{quote_plus(query)}&start=0&max_results={max_results}"
-    feed = feedparser.parse(url)
-    return [{"title": e.title, "summary": e.summary, "link": e.link} for e in feed.entries]
+    resp = await client.get(url)
+    resp.raise_for_status()
+    # Parse off the event loop so in-flight PubMed requests keep progressing
+    papers = await asyncio.get_running_loop().run_in_executor(
+        None, parse_arxiv_feed, resp.content
+    )
+    ARXIV_CACHE[key] = papers
+    return papers
 
 
-def fetch_pubmed_papers(query, max_results=3):
-    search = requests.get(PUBMED_API, params={
+async def fetch_pubmed_async(client, query, max_results=3):
+    key = (normalize_query(query), max_results)
+    if key in PUBMED_CACHE:
+        return PUBMED_CACHE[key]
+
+    search_resp = await ncbi_get(client, PUBMED_API, {
         "db": "pubmed",
         "term": query,
         "retmode": "json",
         "retmax": max_results
-    }, timeout=10).json()
+    })
+    search = orjson.loads(search_resp.content)
+
+    # eutils can report errors in a 200 body; only a real result is cacheable
+    if "esearchresult" not in search or "ERROR" in search["esearchresult"]:
+        raise ValueError(f"PubMed esearch failed: {search.get('error') or search.get('esearchresult')}")
 
-    ids = search.get("esearchresult", {}).get("idlist", [])
+    ids = search["esearchresult"].get("idlist", [])
     if not ids:
+        PUBMED_CACHE[key] = []
         return []
 
-    abstracts = requests.get(PUBMED_FETCH, params={
+    fetch_resp = await ncbi_get(client, PUBMED_FETCH, {
         "db": "pubmed",
         "id": ",".join(ids),
         "retmode": "text",
         "rettype": "abstract"
-    }, timeout=10).text
+    })
+    abstracts = fetch_resp.text
 
-    return [{
+    papers = [{
         "title": f"PubMed Article {pid}",
         "summary": abstracts[:1000],
         "link": f"https://pubmed.ncbi.nlm.nih.gov/{pid}/"
     } for pid in ids]
+    PUBMED_CACHE[key] = papers
+    return papers
+
+
+async def fetch_and_compact_async(fetch, query):
+    """Return (entries, ok); ok is False when the source failed."""
+    # A failing source contributes no papers rather than sinking the other one;
+    # nothing is cached for it, so the next question retries.
+    try:
+        papers = await fetch(HTTP, query)
+    except (httpx.HTTPError, etree.XMLSyntaxError, ValueError, RateLimited) as e:
+        app.logger.warning("%s failed for %r: %s", fetch.__name__, query, e)
+        return [], False
+    # Tokenize this source's papers while the other source is still in flight
+    entries = await asyncio.get_running_loop().run_in_executor(
+        None, compact_papers, papers
+    )
+    return entries, True
+
+
+async def fetch_research_async(query):
+    # arXiv and PubMed (esearch -> efetch) overlap instead of running back to back
+    (arxiv, arxiv_ok), (pubmed, pubmed_ok) = await asyncio.gather(
+        fetch_and_compact_async(fetch_arxiv_async, query),
+        fetch_and_compact_async(fetch_pubmed_async, query)
+    )
+    return arxiv + pubmed, arxiv_ok and pubmed_ok
+
+
+def fetch_research(query):
+    # Sync entry point for the Flask routes; returns (entries, complete)
+    return run_async(fetch_research_async(query))
 
 # =================================================
 #                 AI ANSWER WITH MEMORY
 # =================================================
 
-def answer_with_memory(chat_messages, question):
-    papers = fetch_arxiv_papers(question) + fetch_pubmed_papers(question)
+_encoding = None
+_encoding_retry_at = 0.0
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    # Loaded on first use: tiktoken may download the BPE file, which must not
+    # block (or break) import when there is no outbound network. Only a loaded
+    # encoding is kept; after a failure the load is retried once the backoff
+    # has passed, and callers truncate by characters in the meantime.
+    global _encoding, _encoding_retry_at
+    if _encoding is not None:
+        return _encoding
+    if time.monotonic() < _encoding_retry_at:
+        return None
+    if not _encoding_lock.acquire(blocking=False):
+        return None  # another thread is loading it
+    try:
+        if _encoding is None:
+            _encoding = tiktoken.encoding_for_model(MODEL)
+    except Exception as e:
+        _encoding_retry_at = time.monotonic() + ENCODING_RETRY_INTERVAL
+        app.logger.warning("tiktoken unavailable, truncating by characters: %s", e)
+    finally:
+        _encoding_lock.release()
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text, limit):
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:limit * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text)
+    if len(tokens) <= limit:
+        return text
+    return encoding.decode(tokens[:limit])
+
+
+def compact_papers(papers):
+    """Return (line, token_count) pairs, one single-line entry per paper."""
+    entries = []
+    for p in papers:
+        summary = truncate_tokens(" ".join(p["summary"].split()), MAX_TOKENS_PER_PAPER)
+        line = f"{p['title']} — {summary} ({p['link']})"
+        entries.append((line, count_tokens(line)))
+    return entries
+
+
+def build_research_context(entries):
+    lines = []
+    total = 0
+    for i, (line, n_tokens) in enumerate(entries, start=1):
+        if total + n_tokens > MAX_CONTEXT_TOKENS:
+            break
+        lines.append(f"[{i}] {line}")
+        total += n_tokens
+    return "\n".join(lines)
 
-    research_context = "\n\n".join(
-        f"Title: {p['title']}\nSummary: {p['summary']}\nSource: {p['link']}"
-        for p in papers
-    )
 
-    system_prompt = {
-        "role": "system",
-        "content": (
-            "You are a medical research assistant.\n"
-            "You MUST use previous conversation context.\n"
-            "You MUST ground answers in scientific research.\n"
-            "If evidence is weak, say so clearly."
-        )
-    }
+def answer_with_memory(chat_messages, question):
+    """Yield the answer text incrementally as the model generates it."""
+    key = answer_cache_key(chat_messages, question)
+    with _answer_cache_lock:
+        cached_answer = ANSWER_CACHE.get(key)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    entries, complete = fetch_research(question)
+    research_context = build_research_context(entries)
 
-    messages = [system_prompt]
+    messages = [SYSTEM_PROMPT]
 
     # 🔹 Include last 10 messages for memory
     messages.extend(chat_messages[-10:])
 
     messages.append({
         "role": "user",
-        "content": f"RESEARCH:\n{research_context}\n\nQUESTION:\n{question}"
+        "content": USER_PROMPT_TEMPLATE.format(context=research_context, question=question)
     })
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
+    parts = []
+    # The context manager closes the HTTP stream even if the client disconnects
+    # and this generator is closed mid-answer.
+    with client.chat.completions.create(
+        model=MODEL,
         messages=messages,
         temperature=0.2,
-        max_tokens=600
-    )
-
-    return response.choices[0].message.content.strip()
+        max_tokens=600,
+        stream=True
+    ) as response:
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                yield delta
+
+    # Empty answers, or ones built while a source was down, are not reused
+    answer = "".join(parts).strip()
+    if answer and complete:
+        with _answer_cache_lock:
+            ANSWER_CACHE[key] = answer
 
 # =================================================
 #                     ROUTES
 # =================================================
 
+def json_response(data, status=200):
+    return app.response_class(orjson.dumps(data), status=status, mimetype="application/json")
+
+
 @app.route("/")
 def home():
     session.setdefault("conversations", {})
@@ -132,7 +442,7 @@ def new_chat():
     session["conversations"][chat_id] = []
     session["active_chat"] = chat_id
     session.modified = True
-    return jsonify({"chat_id": chat_id})
+    return json_response({"chat_id": chat_id})
 
 
 @app.route("/switch_chat/<chat_id>")
@@ -148,27 +458,80 @@ def get_response():
     user_input = data.get("message", "").strip()
 
     if not user_input:
-        return jsonify({"error": "Empty message"}), 400
+        return json_response({"error": "Empty message"}, 400)
 
     chat_id = session["active_chat"]
     chat_messages = session["conversations"][chat_id]
 
     # Save user message
     chat_messages.append({"role": "user", "content": user_input})
+    session.modified = True
+
+    # The session cookie is sent before the body streams, so the client posts
+    # the signed finished answer back to /save_response.
+    history = list(chat_messages)
+    turn = len(chat_messages)
+
+    def generate():
+        # Headers are already sent once streaming starts, so failures are
+        # reported in-band as an "error" event.
+        parts = []
+        try:
+            for delta in answer_with_memory(history, user_input):
+                parts.append(delta)
+                yield b"data: " + orjson.dumps({"delta": delta}) + b"\n\n"
+        except Exception:
+            app.logger.exception("Answer generation failed")
+            yield b"event: error\ndata: " + orjson.dumps(
+                {"error": "Sorry, something went wrong while generating the answer."}
+            ) + b"\n\n"
+            return
+
+        answer = "".join(parts).strip()
+        token = answer_signer.dumps(
+            {"chat_id": chat_id, "turn": turn, "answer": answer}
+        ) if answer else None
+        yield b"event: done\ndata: " + orjson.dumps({"token": token}) + b"\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-    answer = answer_with_memory(chat_messages, user_input)
 
-    # Save assistant message
-    chat_messages.append({"role": "assistant", "content": answer})
+@app.route("/save_response", methods=["POST"])
+def save_response():
+    data = request.json
+    token = data.get("token")
 
+    if not isinstance(token, str) or not token:
+        return json_response({"error": "Invalid or expired answer"}, 400)
+
+    try:
+        pending = answer_signer.loads(token, max_age=SAVE_RESPONSE_MAX_AGE)
+    except BadSignature:
+        return json_response({"error": "Invalid or expired answer"}, 400)
+
+    chat_messages = session.get("conversations", {}).get(pending["chat_id"])
+    if chat_messages is None:
+        return json_response({"error": "Unknown chat"}, 404)
+
+    # Only answer the user turn this response was generated for
+    if len(chat_messages) != pending["turn"] or chat_messages[-1]["role"] != "user":
+        return json_response({"error": "Conversation has moved on"}, 409)
+
+    # Save assistant message
+    chat_messages.append({"role": "assistant", "content": pending["answer"]})
     session.modified = True
 
-    return jsonify({"bot": answer})
+    return json_response({"ok": True})
 
 # =================================================
 #                     MAIN
 # =================================================
 
+# Local development only; production runs under gunicorn (see Procfile).
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)